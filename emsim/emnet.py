@@ -4,6 +4,7 @@ emnet.py
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 netdebug = False
 EVT_SIZE = 11     # size of event grid (in X and Y)
@@ -21,36 +22,28 @@ class FCNet(nn.Module):
         self.fc2 = nn.Linear(256, 512)
         self.fc3 = nn.Linear(512, 2) #ERR_SIZE*ERR_SIZE)
         self.drop1 = nn.Dropout(p=0.3)
-        self.relu = nn.ReLU()
-        self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
-
-        if(netdebug): print("Init:",x.shape)
         x = torch.flatten(x, start_dim=1)
-
-        if(netdebug): print("Flatten:",x.shape)
-        x = self.fc1(x)
-
-        if(netdebug): print("FC1:",x.shape)
-        x = self.relu(x)
-        x = self.drop1(x)
-        x = self.fc2(x)
-
-        if(netdebug): print("FC2:",x.shape)
-        x = self.relu(x)
-        x = self.drop1(x)
+        x = self.drop1(F.relu(self.fc1(x), inplace=True))
+        x = self.drop1(F.relu(self.fc2(x), inplace=True))
         x = self.fc3(x)
-
-        if(netdebug): print("FC3:",x.shape)
-        #x = self.sigmoid(x)
-
         return x
 
 class basicCNN(nn.Module):
-    def __init__(self):
+    def __init__(self, conv_bn_relu=False):
+        """
+        conv_bn_relu: if True, use the Conv->BN->ReLU ordering in each conv
+                      block, which allows the BatchNorms to be folded into the
+                      convs with fuse(). The default (False) keeps the
+                      Conv->ReLU->BN ordering that existing checkpoints were
+                      trained with; the state_dict keys are the same for both,
+                      so a checkpoint must be loaded into a model built with
+                      the ordering it was trained with.
+        """
         super(basicCNN, self).__init__()
 
+        self.conv_bn_relu = conv_bn_relu
         self.conv1 = nn.Conv2d(1, chi, 4, padding=1)
         self.bn1   = nn.BatchNorm2d(chi)
         self.conv2 = nn.Conv2d(chi, chi*2, 3, padding=1)
@@ -70,23 +63,45 @@ class basicCNN(nn.Module):
                 nn.init.constant_(m.weight, 1)
                 nn.init.constant_(m.bias, 0)
 
+        # Use NHWC layout for the conv stack.
+        self.to(memory_format=torch.channels_last)
+
     def forward(self, x):
-        if(netdebug): print(x.shape)
-        x = self.pool4(self.bn1(F.relu(self.conv1(x))))
-        if(netdebug): print(x.shape)
-        x = self.pool3(self.bn2(F.relu(self.conv2(x))))
-        if(netdebug): print(x.shape)
-        x = self.pool2(self.bn3(F.relu(self.conv3(x))))
-        if(netdebug): print(x.shape)
+        x = x.contiguous(memory_format=torch.channels_last)
+        if self.conv_bn_relu:
+            x = self.pool4(F.relu(self.bn1(self.conv1(x)), inplace=True))
+            x = self.pool3(F.relu(self.bn2(self.conv2(x)), inplace=True))
+            x = self.pool2(F.relu(self.bn3(self.conv3(x)), inplace=True))
+        else:
+            x = self.pool4(self.bn1(F.relu(self.conv1(x), inplace=True)))
+            x = self.pool3(self.bn2(F.relu(self.conv2(x), inplace=True)))
+            x = self.pool2(self.bn3(F.relu(self.conv3(x), inplace=True)))
         x = x.flatten(start_dim=1)
-        #x = x.view(-1, chi*16 * 1)
-        if(netdebug): print(x.shape)
         x = self.drop1(x)
         x = self.fc(x)
-
-
         return x
 
+    def fuse(self):
+        """
+        Fold each BatchNorm into the preceding Conv2d for inference.
+
+        The BatchNorm layers are replaced by identities, so the model can no
+        longer be trained after calling this. Only models built with
+        conv_bn_relu=True can be fused (a BatchNorm after the ReLU cannot be
+        folded into the conv).
+        """
+        if not self.conv_bn_relu:
+            raise ValueError("fuse() requires a basicCNN built with conv_bn_relu=True")
+        self.eval()
+        for conv_name, bn_name in (("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")):
+            conv = getattr(self, conv_name)
+            bn = getattr(self, bn_name)
+            if isinstance(bn, nn.Identity):
+                continue
+            setattr(self, conv_name, fuse_conv_bn_eval(conv, bn))
+            setattr(self, bn_name, nn.Identity())
+        return self
+
 # Basic CNN for regression-based solution.
 class basicCNN_reg(nn.Module):
     def __init__(self):
@@ -134,3 +149,44 @@ class basicCNN_reg(nn.Module):
         if(netdebug): print(x.shape)
 
         return x
+
+
+def compile_for_inference(model, example_input=None):
+    """
+    Script, freeze, and optimize a model (e.g. FCNet or basicCNN) for inference.
+
+    model: the model to be compiled; it is put in eval mode
+    example_input: if given, a batch used to run a warmup pass so that the
+                   (slow) first-call optimization happens here rather than in
+                   the first real inference call
+
+    The returned module holds a frozen copy of the model's current weights
+    (with Conv-BN pairs folded), so it does not follow later training,
+    load_state_dict, or fuse() calls on the model; keep the returned module
+    for repeated inference, and call this again after changing the weights.
+    """
+    model.eval()
+    scripted = torch.jit.script(model)
+    frozen = torch.jit.freeze(scripted)
+    optimized = torch.jit.optimize_for_inference(frozen)
+
+    if example_input is not None:
+        with torch.no_grad(), torch.jit.optimized_execution(True):
+            for _ in range(2):
+                optimized(example_input)
+
+    return optimized
+
+
+def quantize_for_cpu_inference(model):
+    """
+    Return a copy of the model with its Linear layers dynamically quantized to
+    INT8, for inference on CPU (INT8 is not faster than FP16 on GPU).
+
+    model: the model to be quantized (e.g. FCNet or basicCNN); it is put in eval mode
+
+    Only nn.Linear layers are quantized: all of FCNet, and basicCNN.fc (the
+    convolutions stay in FP32).
+    """
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
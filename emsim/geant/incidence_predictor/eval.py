@@ -50,6 +50,7 @@ def eval_gaussian_model(model: nn.Module, dataset: GeantElectronDataset, device=
     com_errors = []
     loader = DataLoader(dataset, collate_fn=electron_collate_fn)
 
+    model.eval()
     with torch.no_grad():
         for batch in loader:
             patches = batch["pixel_patches"].to(device)
@@ -1,18 +1,113 @@
+from functools import lru_cache
+from typing import NamedTuple
+
 import torch
 import torch.nn.functional as F
 from torch import nn
-from torch.distributions import MultivariateNormal
-from math import log
+from math import log, pi
+
+
+def gaussian2d_logprob(
+    mean: torch.Tensor, scale_tril: torch.Tensor, value: torch.Tensor
+) -> torch.Tensor:
+    """Log density of a bivariate normal with the given mean (..., 2) and lower
+    triangular Cholesky factor of the covariance (..., 2, 2), evaluated at
+    `value` (..., 2). The 2x2 triangular solve is written out in closed form."""
+    diff = value - mean
+    l00 = scale_tril[..., 0, 0]
+    l10 = scale_tril[..., 1, 0]
+    l11 = scale_tril[..., 1, 1]
+    z0 = diff[..., 0] / l00
+    z1 = (diff[..., 1] - l10 * z0) / l11
+    return -0.5 * (z0 * z0 + z1 * z1) - torch.log(l00 * l11) - log(2 * pi)
+
+
+class BivariateNormal(NamedTuple):
+    """Lightweight stand-in for torch.distributions.MultivariateNormal in 2D,
+    without the per-construction argument validation."""
+
+    mean: torch.Tensor
+    scale_tril: torch.Tensor
+
+    @property
+    def covariance_matrix(self) -> torch.Tensor:
+        return self.scale_tril @ self.scale_tril.transpose(-1, -2)
+
+    def log_prob(self, value: torch.Tensor) -> torch.Tensor:
+        return gaussian2d_logprob(self.mean, self.scale_tril, value)
+
+
+def _cached_patch_shape(module: nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """Returns the (height, width) of the input patches as a float tensor on
+    the input's device, reusing the module's `_patch_shape` buffer unless the
+    patch size or device has changed since the last call. A buffer created
+    under torch.inference_mode() is also rebuilt outside it, since inference
+    tensors can't be saved for backward."""
+    patch_hw = tuple(x.shape[-2:])
+    if (
+        module._patch_shape is None
+        or module._patch_hw != patch_hw
+        or module._patch_shape.device != x.device
+        or (module._patch_shape.is_inference() and not torch.is_inference_mode_enabled())
+    ):
+        module._patch_shape = torch.tensor(patch_hw, dtype=torch.float, device=x.device)
+        module._patch_hw = patch_hw
+    return module._patch_shape
+
+
+def gaussian_head(
+    x: torch.Tensor,
+    patch_shape: torch.Tensor,
+    diagonal_covariance: bool,
+    sigmoid_mean: bool,
+    log_max_cov: float,
+    eps: float,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Converts the raw predictor output (..., 4 or 5) into the mean (..., 2)
+    and Cholesky factor (..., 2, 2) of the predicted incidence point
+    distribution."""
+    if diagonal_covariance:
+        mean_vector, cholesky_diagonal = torch.split(x, [2, 2], -1)
+    else:
+        mean_vector, cholesky_diagonal, cholesky_offdiag = torch.split(x, [2, 2, 1], -1)
+
+    cholesky_diagonal = torch.clamp_max(cholesky_diagonal, log_max_cov)
+    cholesky_diagonal = cholesky_diagonal.exp()
+    cholesky_diagonal = torch.clamp_min(cholesky_diagonal, eps)
+    cholesky = x.new_zeros(*x.shape[:-1], 2, 2)
+    cholesky.diagonal(dim1=-2, dim2=-1).copy_(cholesky_diagonal)
+    if not diagonal_covariance:
+        # the only strictly lower triangular element of a 2x2 matrix
+        cholesky[..., 1, 0] = cholesky_offdiag.squeeze(-1)
+
+    # parameterization choices
+    if sigmoid_mean:
+        mean_vector = F.sigmoid(mean_vector)
+        # scale the mean vector to the size of the patch
+        mean_vector = mean_vector * patch_shape
+        # cholesky = cholesky / patch_shape.unsqueeze(-1)
+
+    return mean_vector, cholesky
+
+
+@lru_cache
+def _compiled_gaussian_head():
+    # compiled lazily so that importing this module does not require a working
+    # torch.compile backend
+    return torch.compile(gaussian_head, mode="reduce-overhead", fullgraph=True)
 
 
 class GaussianIncidencePointPredictor(nn.Module):
-    def __init__(self, backbone, hidden_dim=512, mean_parameterization="sigmoid", diagonal_covariance=False, eps=1e-6, max_cov=1e5):
+    def __init__(self, backbone, hidden_dim=512, mean_parameterization="sigmoid", diagonal_covariance=False, eps=1e-6, max_cov=1e5, compile=False):
         super().__init__()
         self.mean_parameterization = mean_parameterization
+        self.compile_head = compile
         self.backbone = backbone
         self.diagonal_covariance = diagonal_covariance
         self.eps = eps
         self.log_max_cov = log(max_cov)
+        self.register_buffer("_patch_shape", None, persistent=False)
+        self._patch_hw = None
 
         if diagonal_covariance:
             out_dim = 4
@@ -24,36 +119,34 @@ class GaussianIncidencePointPredictor(nn.Module):
             nn.ReLU(),
             nn.Linear(hidden_dim, out_dim),
         )
+        if compile:
+            # compiled in place so the state_dict keys are unchanged
+            self.predictor.compile(mode="reduce-overhead")
+            self.backbone.to(memory_format=torch.channels_last)
 
     def forward(self, x):
-        patch_shape = torch.as_tensor(x.shape[-2:], dtype=torch.float, device=x.device)
+        patch_shape = _cached_patch_shape(self, x)
         # patch_center_coords = patch_shape / 2
+        if self.compile_head and x.layout == torch.strided and x.ndim == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = self.backbone(x)
         x = self.predictor(x)
 
-        if self.diagonal_covariance:
-            mean_vector, cholesky_diagonal = torch.split(x, [2, 2], -1)
-        else:
-            mean_vector, cholesky_diagonal, cholesky_offdiag = torch.split(x, [2, 2, 1], -1)
-
-        cholesky_diagonal = torch.clamp_max(cholesky_diagonal, self.log_max_cov)
-        cholesky_diagonal = cholesky_diagonal.exp()
-        cholesky_diagonal = torch.clamp_min(cholesky_diagonal, self.eps)
-        cholesky = torch.diag_embed(cholesky_diagonal)
-        if not self.diagonal_covariance:
-            tril_indices = torch.tril_indices(2, 2, offset=-1, device=x.device)
-            cholesky[:, tril_indices[0], tril_indices[1]] = cholesky_offdiag
-
-        # parameterization choices
-        if self.mean_parameterization == "sigmoid":
-            mean_vector = F.sigmoid(mean_vector)
-            # scale the mean vector to the size of the patch
-            scaling_matrix = torch.diag_embed(patch_shape)
-            # inverse_scaling_matrix = torch.diag_embed(1 / patch_shape)
-            mean_vector = torch.squeeze(scaling_matrix @ mean_vector.unsqueeze(-1), -1)
-            # cholesky = inverse_scaling_matrix @ cholesky
-
-        return MultivariateNormal(mean_vector, scale_tril=cholesky)
+        mean_vector, cholesky = self._gaussian_head(
+            x,
+            patch_shape,
+            self.diagonal_covariance,
+            self.mean_parameterization == "sigmoid",
+            self.log_max_cov,
+            self.eps,
+        )
+        return BivariateNormal(mean_vector, cholesky)
+
+    @property
+    def _gaussian_head(self):
+        if self.compile_head:
+            return _compiled_gaussian_head()
+        return gaussian_head
 
     @property
     def device(self):
@@ -64,6 +157,8 @@ class IncidencePointPredictor(nn.Module):
     def __init__(self, backbone, hidden_dim=512):
         super().__init__()
         self.backbone = backbone
+        self.register_buffer("_patch_shape", None, persistent=False)
+        self._patch_hw = None
 
         self.predictor = nn.Sequential(
             nn.Linear(self.backbone.num_features, hidden_dim),
@@ -73,7 +168,7 @@ class IncidencePointPredictor(nn.Module):
         )
 
     def forward(self, x):
-        patch_shape = torch.as_tensor(x.shape[-2:], device=x.device)
+        patch_shape = _cached_patch_shape(self, x)
         x = self.backbone(x)
         x = self.predictor(x)
         x = x * patch_shape
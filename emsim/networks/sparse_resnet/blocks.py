@@ -117,6 +117,22 @@ class SparseBottleneck(nn.Module):
         return x
 
 
+class SparseNormActConv(spconv.SparseSequential):
+    """norm -> act -> sparse conv. Unlike a plain SparseSequential, which wraps
+    the result of each dense layer in a new SparseConvTensor, the norm and
+    activation are applied to the feature matrix back to back and only one
+    intermediate SparseConvTensor is created before the conv."""
+
+    def __init__(self, norm: nn.Module, act: nn.Module, conv: spconv.SparseModule):
+        super().__init__(norm, act, conv)
+
+    def forward(self, x: spconv.SparseConvTensor):
+        norm, act, conv = self._modules.values()
+        if x.indices.shape[0] != 0:
+            x = x.replace_feature(act(norm(x.features)))
+        return conv(x)
+
+
 class SparseBottleneckV2(spconv.SparseModule):
     def __init__(
         self,
@@ -144,6 +160,7 @@ class SparseBottleneckV2(spconv.SparseModule):
         # mid_chs = make_divisible(out_chs * bottle_ratio)
         mid_chs = int(out_chs * bottle_ratio)
 
+        padding_3x3 = get_padding(3, stride=stride, dilation=dilation)
         if stride > 1:
             conv_layer = spconv.SparseConv2d
             indice_key_3x3 = f"down_3x3_{in_reduction}to{out_reduction}"
@@ -159,7 +176,7 @@ class SparseBottleneckV2(spconv.SparseModule):
                 kernel_size=3,
                 stride=stride,
                 dilation=dilation,
-                padding=get_padding(3, stride=stride, dilation=dilation),
+                padding=padding_3x3,
                 indice_key=indice_key_3x3,
             )
         else:
@@ -176,7 +193,7 @@ class SparseBottleneckV2(spconv.SparseModule):
             indice_key=f"1x1_subm_{in_reduction}"
         )
 
-        self.norm_relu_conv_2 = spconv.SparseSequential(
+        self.norm_relu_conv_2 = SparseNormActConv(
             norm_layer(mid_chs),
             act_layer(),
             conv_layer(
@@ -185,11 +202,11 @@ class SparseBottleneckV2(spconv.SparseModule):
                 kernel_size=3,
                 stride=stride,
                 dilation=dilation,
-                padding=get_padding(3, stride=stride, dilation=dilation),
+                padding=padding_3x3,
                 indice_key=indice_key_3x3,
             ),
         )
-        self.norm_relu_conv_3 = spconv.SparseSequential(
+        self.norm_relu_conv_3 = SparseNormActConv(
             norm_layer(mid_chs),
             act_layer(),
             spconv.SubMConv2d(
@@ -213,10 +230,12 @@ class SparseBottleneckV2(spconv.SparseModule):
         x = self.norm_relu_conv_2(x)
         x = self.norm_relu_conv_3(x)
         x = self.drop_path(x)
-        # if x.indices.shape != shortcut.indices.shape:
-        #     out = Fsp.sparse_add(x, shortcut)
-        # else:
-        #     out = x + shortcut
+        # Both branches end in convs sharing an indice_key, so they have the
+        # same active sites in the same order and the residual is a plain
+        # feature add. Fsp.sparse_add is not a safe fallback for mismatched
+        # sites: it re-sorts the active sites but can keep an input's
+        # indice_dict, so later convs reusing those indice_keys would apply
+        # cached pairs to reordered rows.
         assert x.indices.shape == shortcut.indices.shape
         out = x + shortcut
         return out
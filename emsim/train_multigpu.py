@@ -3,6 +3,8 @@ train_multigpu.py
 
 Script for training on multiple GPUs.
 """
+import os
+
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -16,7 +18,6 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
-from torch.autograd import Variable
 
 from unet import UNet
 import scipy.optimize as optimize
@@ -36,9 +37,10 @@ dataset_all   = tr.EMDataset("/global/cscratch1/sd/jrenner1/data/EM_4um_back_10M
 dataset_train = tr.EMDataset("/global/cscratch1/sd/jrenner1/data/EM_4um_back_10M_300keV.pkl",noise_mean=0,noise_sigma=20,add_noise=True,nstart=20000,nend=100000,add_shift=0)
 dataset_val   = tr.EMDataset("/global/cscratch1/sd/jrenner1/data/EM_4um_back_10M_300keV.pkl",noise_mean=0,noise_sigma=20,add_noise=True,nstart=0,nend=20000,add_shift=0)
 
-# Create the loaders.
-train_loader = DataLoader(dataset_train, batch_size=1000, shuffle=True, collate_fn=tr.my_collate, num_workers=32)
-val_loader = DataLoader(dataset_val, batch_size=1000, shuffle=True, collate_fn=tr.my_collate, num_workers=32)
+# Create the loaders (keeping the workers alive across epochs).
+num_workers = max(os.cpu_count()//2, 1)
+train_loader = tr.CUDAPrefetcher(DataLoader(dataset_train, batch_size=1000, shuffle=True, collate_fn=tr.my_collate, num_workers=num_workers, pin_memory=True, persistent_workers=True, prefetch_factor=2))
+val_loader = tr.CUDAPrefetcher(DataLoader(dataset_val, batch_size=1000, shuffle=True, collate_fn=tr.my_collate, num_workers=num_workers, pin_memory=True, persistent_workers=True, prefetch_factor=2))
 #test_loader = DataLoader(dataset_test, batch_size=15, shuffle=True, collate_fn=tr.my_collate, num_workers=4)
 
 # Define the model.
@@ -3,51 +3,132 @@ training.py
 
 Methods for training (and validation) of EM electron model.
 """
+import os
+
 import h5py
 import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision
+import torchvision.transforms.functional as TF
 
+from numba import njit
 from torch.utils.data import Dataset
-from torch.autograd import Variable
-from PIL import Image
 
 import emsim.emnet as emnet
 
 # Flag for data augmentation
 augment = False
 
+# Random number generator for this process (see get_rng).
+_rng = None
+_rng_pid = None
+
+# Get the random number generator for this process. In a DataLoader worker it is seeded from the worker seed, so the
+# workers draw different numbers and runs can be reproduced with torch.manual_seed; it is recreated in forked
+# processes so that they do not share the parent's state.
+def get_rng():
+    global _rng, _rng_pid
+    if(_rng is None or _rng_pid != os.getpid()):
+        worker_info = torch.utils.data.get_worker_info()
+        seed = worker_info.seed if worker_info is not None else torch.initial_seed()
+        _rng = np.random.default_rng(seed)
+        _rng_pid = os.getpid()
+    return _rng
+
 # Modified from medicaltorch.transforms: https://github.com/perone/medicaltorch/blob/master/medicaltorch/transforms.py
 def rotate3D(data,axis=0):
-    angle = np.random.uniform(-20,20)
-    drot  = np.zeros(data.shape, dtype=data.dtype)
+    angle = get_rng().uniform(-20,20)
 
-    for x in range(data.shape[axis]):
-        if axis == 0:
-            drot[x,:,:] = Image.fromarray(data[x,:,:]).rotate(angle,resample=False,expand=False,center=None,fillcolor=0)
-        if axis == 1:
-            drot[:,x,:] = Image.fromarray(data[:,x,:]).rotate(angle,resample=False,expand=False,center=None,fillcolor=0)
-        if axis == 2:
-            drot[:,:,x] = Image.fromarray(data[:,:,x]).rotate(angle,resample=False,expand=False,center=None,fillcolor=0)
+    # Rotate all slices perpendicular to the axis at once (nearest-neighbor, filling with 0).
+    # This matches the PIL rotation of each slice on the 11x11 event frames; on larger slices, nearest-neighbor rounding
+    # can differ from PIL's for pixels that land on a rounding boundary (about 0.05% of pixels at 101x101).
+    drot = torch.from_numpy(np.moveaxis(data,axis,0))
+    drot = TF.rotate(drot,angle,interpolation=TF.InterpolationMode.NEAREST,expand=False,center=None,fill=0)
 
-    return drot
+    return np.moveaxis(drot.numpy(),0,axis)
 
 # Add a random gaussian noise to the data.
-def gaussnoise(data, mean=0.0, stdev=0.05):
-    dnoise = data + np.random.normal(loc=mean,scale=stdev,size=data.shape)
-    return dnoise
+# If out is given (a float32 array of the same shape, distinct from data), the noisy data is computed in it in place.
+def gaussnoise(data, mean=0.0, stdev=0.05, out=None):
+    # (float32 noise, so that float32 data is not promoted to float64)
+    if(out is None):
+        dnoise = data + (get_rng().standard_normal(size=data.shape, dtype=np.float32)*stdev + mean)
+        return dnoise
+
+    get_rng().standard_normal(out=out, dtype=np.float32)
+    out *= stdev
+    out += mean
+    out += data
+    return out
+
+# Add an event to the frame centered on pixel (row, col), clipping the event at the frame edges.
+@njit(cache=True)
+def add_event_to_frame(frame, evt_arr, row, col):
+    di = evt_arr.shape[0] // 2  # the extent of the event from the center pixel
+    dj = evt_arr.shape[1] // 2
+
+    # Clip the bounds with selects rather than branches.
+    ileft = row-di if row-di > 0 else 0
+    jleft = col-dj if col-dj > 0 else 0
+    iright = row+di+1 if row+di+1 < frame.shape[0] else frame.shape[0]
+    jright = col+dj+1 if col+dj+1 < frame.shape[1] else frame.shape[1]
+    for i in range(ileft, iright):
+        for j in range(jleft, jright):
+            frame[i,j] += evt_arr[i-row+di,j-col+dj]
+
+# Compute in a single pass over the frame the edge truth (pixels in the light region of the line row = m*col + b),
+# the distance of each pixel to the line, and the location of the maximum of (frame - offset) over the light region,
+# with pixels in the dark region counted as 0. If the maximum is not unique, the middle one in row-major order is used.
+@njit(cache=True)
+def edge_truth_dist_argmax(frame, offset, m, b, light_region):
+    edge_truth = np.empty(frame.shape, dtype=np.bool_)
+    dist = np.empty(frame.shape, dtype=np.float32)
+    norm = m**2 + 1
+    vmax = -np.inf
+    nmax = 0
+    for i in range(frame.shape[0]):
+        for j in range(frame.shape[1]):
+            line = m*j + b
+            edge = i >= line if light_region == 0 else i <= line
+            edge_truth[i,j] = edge
+            dist[i,j] = (m*j - i + b) / norm
+            v = frame[i,j] - offset if edge else 0.0
+            if v > vmax:
+                vmax = v
+                nmax = 1
+            elif v == vmax:
+                nmax += 1
+
+    # Find the middle occurrence of the maximum.
+    k = nmax // 2
+    imax, jmax = 0, 0
+    for i in range(frame.shape[0]):
+        for j in range(frame.shape[1]):
+            v = frame[i,j] - offset if edge_truth[i,j] else 0.0
+            if v == vmax:
+                if k == 0:
+                    imax, jmax = i, j
+                k -= 1
+            if k < 0:
+                break
+        if k < 0:
+            break
+
+    return edge_truth, dist, (imax, jmax)
 
 def create_L_event():
-    evt_arr = np.zeros([101,101])
+    evt_arr = np.zeros([101,101], dtype=np.float32)
 
-    horiz = np.random.rand() > 0.5  # long leg of L is horizontal (over columns)
-    dir1  = np.random.rand() > 0.5  # direction of long leg of L
-    dir2  = np.random.rand() > 0.5  # direction of short leg of L
+    rng = get_rng()
+    horiz = rng.random() > 0.5  # long leg of L is horizontal (over columns)
+    dir1  = rng.random() > 0.5  # direction of long leg of L
+    dir2  = rng.random() > 0.5  # direction of short leg of L
 
     # Choose the random values, and normalize to 1.
-    vals = 0.5*np.random.rand(4) + 0.5
+    vals = 0.5*rng.random(4) + 0.5
     vals /= np.sum(vals)
 
     # Flip the direction of the long leg if dir1 = True
@@ -86,10 +167,10 @@ class EMDataset(Dataset):
         self.add_shift = add_shift
 
         # Open the dataframe.
-        self.df_data = pd.read_pickle(dframe)
+        df_data = pd.read_pickle(dframe)
 
         # Extract the events array.
-        self.events = self.df_data.event.unique()
+        self.events = df_data.event.unique()
 
         # Select the specified range [nstart:nend] for this dataset.
         if(nend == 0):
@@ -99,22 +180,39 @@ class EMDataset(Dataset):
             self.events = self.events[nstart:nend]
             print("Created dataset for events from",nstart,"to",nend)
 
+        # Store the pixels of the selected events as contiguous arrays sorted by event (in the order of self.events),
+        # with the pixels of event i in [evt_offsets[i], evt_offsets[i+1]). The dataframe itself is not kept.
+        evt_idx = pd.Index(self.events).get_indexer(df_data.event.to_numpy())
+        order = np.flatnonzero(evt_idx >= 0)
+        order = order[np.argsort(evt_idx[order], kind='stable')]
+        self.evt_offsets = np.concatenate([[0], np.cumsum(np.bincount(evt_idx[order], minlength=len(self.events)))])
+        self.row_buf = df_data['row'].to_numpy()[order].astype(np.int16)
+        self.col_buf = df_data['col'].to_numpy()[order].astype(np.int16)
+        self.cnt_buf = df_data['counts'].to_numpy()[order].astype(np.float32)
+        self.xinc = df_data.xinc.to_numpy()[order][self.evt_offsets[:-1]].astype(np.float32)
+        self.yinc = df_data.yinc.to_numpy()[order][self.evt_offsets[:-1]].astype(np.float32)
+
+        # Scratch array for the noisy event window used to find the maximum pixel in __getitem__ (relies on each
+        # DataLoader worker process fetching one item at a time on a single thread).
+        self._noisy_window = np.empty((101,101), dtype=np.float32)
+
     def __len__(self):
         return len(self.events)
 
     def __getitem__(self, idx):
 
-        # Get the event ID corresponding to this key.
-        evt = self.events[idx]
-        df_evt = self.df_data[self.df_data.event == evt]
+        # Get the pixels of the event corresponding to this key.
+        start, end = self.evt_offsets[idx], self.evt_offsets[idx+1]
+        rows, cols, counts = self.row_buf[start:end], self.col_buf[start:end], self.cnt_buf[start:end]
+        xinc, yinc = self.xinc[idx], self.yinc[idx]
 
         # Prepare the event.
         if(self.Ltest):
             evt_arr = create_L_event()
         else:
-            evt_arr = np.zeros([101,101])
-            for row,col,counts in zip(df_evt['row'].values,df_evt['col'].values,df_evt['counts'].values):
-                evt_arr[row,col] += counts
+            # Scatter-add the pixel counts (bincount sums repeated pixels, like evt_arr[row,col] += counts in a loop).
+            flat = rows.astype(np.intp)*101 + cols
+            evt_arr = np.bincount(flat, weights=counts, minlength=101*101).reshape(101,101).astype(np.float32)
 
         # Use a windowed event+noise to determine the maximum pixel if no manual shift specified.
         if(self.add_shift < 0):
@@ -122,7 +220,8 @@ class EMDataset(Dataset):
             ssize = 101
             evt_small = evt_arr[50-int((ssize-1)/2):50+int((ssize-1)/2)+1,50-int((ssize-1)/2):50+int((ssize-1)/2)+1]
             if(self.add_noise):
-                evt_small = gaussnoise(evt_small, mean=self.noise_mean, stdev=self.noise_sigma)
+                # (only used to find the maximum, so computed in a scratch array)
+                evt_small = gaussnoise(evt_small, mean=self.noise_mean, stdev=self.noise_sigma, out=self._noisy_window)
             yx_shift = np.unravel_index(np.argmax(evt_small),evt_small.shape)
             y_shift = yx_shift[0] - int((ssize-1)/2)
             x_shift = yx_shift[1] - int((ssize-1)/2)
@@ -132,21 +231,18 @@ class EMDataset(Dataset):
             x_shift = 0
             y_shift = 0
 
-        # Extract the specified event size from the larger event, centered on the maximum pixel.
+        # Add a manual shift, if specified (applied by shifting the extraction window below).
+        if(self.add_shift > 0):
+
+            x_shift = get_rng().integers(-self.add_shift,self.add_shift)
+            y_shift = get_rng().integers(-self.add_shift,self.add_shift)
+
+        # Extract the specified event size from the larger event, centered on the maximum pixel (or shifted pixel).
         evt_arr = evt_arr[50+y_shift-int((emnet.EVT_SIZE-1)/2):50+y_shift+int((emnet.EVT_SIZE-1)/2)+1,50+x_shift-int((emnet.EVT_SIZE-1)/2):50+x_shift+int((emnet.EVT_SIZE-1)/2)+1]
 
         # Normalize to value of greatest magnitude = 1.
         #evt_arr /= 10000 #np.max(np.abs(evt_arr))
 
-        # Add a manual shift, if specified.
-        if(self.add_shift > 0):
-
-            x_shift = np.random.randint(-self.add_shift,self.add_shift)
-            y_shift = np.random.randint(-self.add_shift,self.add_shift)
-
-            evt_arr = np.roll(evt_arr,x_shift,axis=1)
-            evt_arr = np.roll(evt_arr,y_shift,axis=0)
-
         # Add Gaussian noise.
         if(self.add_noise):
             evt_arr = gaussnoise(evt_arr, mean=self.noise_mean, stdev=self.noise_sigma)
@@ -155,7 +251,7 @@ class EMDataset(Dataset):
         if(self.Ltest):
             err = [-emnet.PIXEL_SIZE*x_shift, -emnet.PIXEL_SIZE*y_shift]
         else:
-            err = [-emnet.PIXEL_SIZE*x_shift + df_evt.xinc.values[0], -emnet.PIXEL_SIZE*y_shift + df_evt.yinc.values[0]]
+            err = [-emnet.PIXEL_SIZE*x_shift + xinc, -emnet.PIXEL_SIZE*y_shift + yinc]
         #err = [df_evt.xinc.values[0], df_evt.yinc.values[0]]
 
         # Construct the error matrix.
@@ -163,12 +259,10 @@ class EMDataset(Dataset):
         SHIFTED_ERR_RANGE_MAX = emnet.PIXEL_ERR_RANGE_MAX + self.add_shift*emnet.PIXEL_SIZE
 
         xbin = int(emnet.ERR_SIZE*(err[0] - SHIFTED_ERR_RANGE_MIN)/(SHIFTED_ERR_RANGE_MAX - SHIFTED_ERR_RANGE_MIN))
-        xbin = max(xbin,0)
-        xbin = min(xbin,emnet.ERR_SIZE-1)
+        xbin = min(max(xbin,0),emnet.ERR_SIZE-1)
 
         ybin = int(emnet.ERR_SIZE*(err[1] - SHIFTED_ERR_RANGE_MIN)/(SHIFTED_ERR_RANGE_MAX - SHIFTED_ERR_RANGE_MIN))
-        ybin = max(ybin,0)
-        ybin = min(ybin,emnet.ERR_SIZE-1)
+        ybin = min(max(ybin,0),emnet.ERR_SIZE-1)
 
         err_ind = (ybin*emnet.ERR_SIZE) + xbin
 
@@ -193,8 +287,8 @@ def my_collate(batch):
         target.append(t)
 
     #print("Max in batch is",np.max(data))
-    data = torch.tensor(data).float().unsqueeze(1)
-    target = torch.tensor(np.array(target)).long()
+    data = torch.from_numpy(np.stack(data).astype(np.float32, copy=False)).unsqueeze(1)
+    target = torch.from_numpy(np.asarray(target)).long()
 
     return (data, target)
 
@@ -219,10 +313,10 @@ def my_collate_reg_line(batch):
         light_region.append(l)
 
     #print("Max in batch is",np.max(data))
-    data = torch.tensor(data).float().unsqueeze(1)
-    arg_max = torch.tensor(arg_max).int() #.unsqueeze(1)
-    evt_err = torch.tensor(evt_err).float()
-    light_region = torch.tensor(light_region).int()
+    data = torch.from_numpy(np.stack(data)).float().unsqueeze(1)
+    arg_max = torch.from_numpy(np.array(arg_max)).int() #.unsqueeze(1)
+    evt_err = torch.from_numpy(np.array(evt_err)).float()
+    light_region = torch.from_numpy(np.array(light_region)).int()
 
     return (data, arg_max, evt_err, light_region)
 
@@ -248,12 +342,12 @@ def my_collate_reg_line_realdata(batch):
         line_b.append(b)
 
     #print("Max in batch is",np.max(data))
-    data = torch.tensor(np.array(data)).float().unsqueeze(1)
-    arg_max = torch.tensor(np.array(arg_max)).int() #.unsqueeze(1)
-    evt_err = torch.tensor(np.array(evt_err)).float()
-    light_region = torch.tensor(np.array(light_region)).int()
-    line_m = torch.tensor(np.array(line_m)).float()
-    line_b = torch.tensor(np.array(line_b)).float()
+    data = torch.from_numpy(np.stack(data)).float().unsqueeze(1)
+    arg_max = torch.from_numpy(np.array(arg_max)).int() #.unsqueeze(1)
+    evt_err = torch.from_numpy(np.array(evt_err)).float()
+    light_region = torch.from_numpy(np.array(light_region)).int()
+    line_m = torch.from_numpy(np.array(line_m)).float()
+    line_b = torch.from_numpy(np.array(line_b)).float()
 
     return (data, arg_max, evt_err, light_region, line_m, line_b)
 
@@ -275,8 +369,8 @@ def my_collate_unet(batch):
         target.append(t)
 
     #print("Max in batch is",np.max(data))
-    data = torch.tensor(data).float().unsqueeze(1)
-    target = torch.tensor(target).float() #.unsqueeze(1)
+    data = torch.from_numpy(np.stack(data)).float().unsqueeze(1)
+    target = torch.from_numpy(np.stack(target)).float() #.unsqueeze(1)
 
     return (data, target)
 
@@ -296,7 +390,7 @@ class RealFrameDataset(Dataset):
         self.revents_m     = f_revents['line_m'][istart:istart+nframes]
         self.revents_b     = f_revents['line_b'][istart:istart+nframes]
         self.revents_i     = np.arange(nframes)
-        np.random.shuffle(self.revents_i)
+        get_rng().shuffle(self.revents_i)
 
         # Load the event arrays for light region 1 (above the line, or on the "left").
         f_levents = np.load(levents_file)
@@ -305,7 +399,7 @@ class RealFrameDataset(Dataset):
         self.levents_m     = f_levents['line_m'][istart:istart+nframes]
         self.levents_b     = f_levents['line_b'][istart:istart+nframes]
         self.levents_i     = np.arange(nframes)
-        np.random.shuffle(self.levents_i)
+        get_rng().shuffle(self.levents_i)
 
     def __len__(self):
         return self.nframes
@@ -317,7 +411,7 @@ class RealFrameDataset(Dataset):
     def get_reg_line_event(self, idx):
 
         # Determine the location of the light region, below (= 0), or above (= 1) the line.
-        light_region = np.random.randint(2)
+        light_region = get_rng().integers(2)
 
         if(light_region == 0):
             # iframe = self.revents_i[idx]
@@ -378,10 +472,21 @@ class EMFrameDataset(Dataset):
         self.lside = lside
         self.res_factor = res_factor     # resolution factor: prediction grid has resolution of event grid * this factor; for now, must be odd
 
-        # Get the row and column indices.
-        indices = np.indices((frame_size,frame_size))
-        self.irows = indices[0]
-        self.icols = indices[1]
+        # Scratch arrays reused by each call of get_hg_event, which are only ever copied into its outputs (never returned
+        # themselves). This relies on each DataLoader worker process fetching one item at a time on a single thread.
+        self._frame = np.empty((frame_size,frame_size), dtype=np.float32)
+        self._frame_truth = np.empty_like(self._frame)
+        self._frame_hrg_truth = np.empty((frame_size*res_factor,frame_size*res_factor), dtype=np.float32)
+        self._th_truth = np.empty_like(self._frame_hrg_truth)
+        self._noisy_frame = np.empty_like(self._frame)
+
+        # Get the flattened indices of the high-resolution grid pixels in the light region below (= 0) or above (= 1)
+        # the line, from which the electron locations are sampled in get_hg_event.
+        if(m_line is not None and b_line is not None):
+            irows_hrg = np.arange(frame_size*res_factor)[:,None]
+            icols_hrg = np.arange(frame_size*res_factor)[None,:]
+            line_hrg = m_line*icols_hrg + b_line*res_factor
+            self.light_idx_hrg = [np.flatnonzero(irows_hrg >= line_hrg), np.flatnonzero(irows_hrg <= line_hrg)]
 
     def __len__(self):
         return self.nframes
@@ -395,13 +500,13 @@ class EMFrameDataset(Dataset):
     def get_reg_line_event(self, idx):
 
         # Create a random event (index does nothing, though could possibly be used as seed).
-        frame = np.zeros([self.frame_size,self.frame_size])
+        frame = np.zeros([self.frame_size,self.frame_size], dtype=np.float32)
 
         # Determine the location of the light region, below (= 0), or above (= 1) the line.
         if(self.lside >= 0):
             light_region = self.lside
         else:
-            light_region = np.random.randint(2)
+            light_region = get_rng().integers(2)
 
         # Add all electrons to the event.
         nelec = 1
@@ -413,7 +518,7 @@ class EMFrameDataset(Dataset):
             # Pick a random location in the frame for the electron.
             loc_chosen = False
             while(not loc_chosen):
-                eloc = np.unravel_index(np.random.randint(frame.size),frame.shape)
+                eloc = np.unravel_index(get_rng().integers(frame.size),frame.shape)
                 if(eloc[0] > 1 and eloc[0] < frame.shape[0]-2 and eloc[1] > 1 and eloc[1] < frame.shape[1]-2):
                     loc_chosen = True
 
@@ -423,7 +528,7 @@ class EMFrameDataset(Dataset):
 
             #ievt = idx
             # Pick a random event from the EM dataset.
-            ievt = np.random.randint(len(self.emdset))
+            ievt = get_rng().integers(len(self.emdset))
 
             evt_item = self.emdset[ievt]
             evt_arr = evt_item[0]
@@ -452,17 +557,10 @@ class EMFrameDataset(Dataset):
             iel += 1
 
             # Add the electron to the frame.
-            delta = int((emnet.EVT_SIZE-1)/2)  # the extent of the event from the center pixel
-            ileft = max(eloc[0]-delta,0); delta_ileft = eloc[0] - ileft
-            jleft = max(eloc[1]-delta,0); delta_jleft = eloc[1] - jleft
-
-            iright = min(eloc[0]+delta+1,frame.shape[0]); delta_iright = iright - eloc[0]
-            jright = min(eloc[1]+delta+1,frame.shape[1]); delta_jright = jright - eloc[1]
-
-            frame[ileft:iright,jleft:jright] += evt_arr[delta-delta_ileft:delta+delta_iright,delta-delta_jleft:delta+delta_jright] #/10000
+            add_event_to_frame(frame, evt_arr, eloc[0], eloc[1])
 
         # Shift the frame so that it's centered on the max pixel.
-        frame_cmax = np.zeros([self.frame_size,self.frame_size])
+        frame_cmax = np.zeros([self.frame_size,self.frame_size], dtype=np.float32)
 
         # Get the maximum pixel.
         arg_max = np.unravel_index(np.argmax(frame),frame.shape)
@@ -482,7 +580,7 @@ class EMFrameDataset(Dataset):
     def get_reg_event(self, idx):
 
         # Create a random event (index does nothing, though could possibly be used as seed).
-        frame = np.zeros([self.frame_size,self.frame_size])
+        frame = np.zeros([self.frame_size,self.frame_size], dtype=np.float32)
 
         # Add all electrons to the event.
         nelec = 1
@@ -499,7 +597,7 @@ class EMFrameDataset(Dataset):
 
             #ievt = idx
             # Pick a random event from the EM dataset.
-            ievt = np.random.randint(len(self.emdset))
+            ievt = get_rng().integers(len(self.emdset))
 
             evt_item = self.emdset[ievt]
             evt_arr = evt_item[0]
@@ -514,14 +612,7 @@ class EMFrameDataset(Dataset):
             iel += 1
 
             # Add the electron to the frame.
-            delta = int((emnet.EVT_SIZE-1)/2)  # the extent of the event from the central pixel
-            ileft = max(eloc[0]-delta,0); delta_ileft = eloc[0] - ileft
-            jleft = max(eloc[1]-delta,0); delta_jleft = eloc[1] - jleft
-
-            iright = min(eloc[0]+delta+1,frame.shape[0]); delta_iright = iright - eloc[0]
-            jright = min(eloc[1]+delta+1,frame.shape[1]); delta_jright = jright - eloc[1]
-
-            frame[ileft:iright,jleft:jright] += evt_arr[delta-delta_ileft:delta+delta_iright,delta-delta_jleft:delta+delta_jright] #/10000
+            add_event_to_frame(frame, evt_arr, eloc[0], eloc[1])
 
             # Get the maximum pixel.
             arg_max = np.unravel_index(np.argmax(frame),frame.shape)
@@ -553,18 +644,15 @@ class EMFrameDataset(Dataset):
     def get_hg_event(self, idx):
 
         # Create a random event (index does nothing, though could possibly be used as seed).
-        frame = np.zeros([self.frame_size,self.frame_size])
-        frame_truth = np.zeros(frame.shape)
+        frame = self._frame; frame.fill(0)
+        frame_truth = self._frame_truth; frame_truth.fill(0)
 
         # ----------------------------------------------------------------------
         # Create the array for the high-resolution-grid truth.
         rfac = self.res_factor
-        frame_hrg_truth = np.zeros([self.frame_size*rfac,self.frame_size*rfac])
+        frame_hrg_truth = self._frame_hrg_truth; frame_hrg_truth.fill(0)
 
-        hrg_frame = np.zeros([self.frame_size*rfac, self.frame_size*rfac])
-        hrg_indices = np.indices((self.frame_size*rfac,self.frame_size*rfac))
-        irows_hrg = hrg_indices[0]
-        icols_hrg = hrg_indices[1]
+        hrg_frame = np.zeros([self.frame_size*rfac, self.frame_size*rfac], dtype=np.float32)
 
         # Determine the number of electrons.
         nelec = 1 #int(np.random.normal(loc=self.nelec_mean,scale=self.nelec_sigma))
@@ -573,52 +661,25 @@ class EMFrameDataset(Dataset):
         if(self.lside >= 0):
             light_region = self.lside
         else:
-            light_region = np.random.randint(2)
+            light_region = get_rng().integers(2)
 
-        # Create the edge truth.
-        if(light_region == 0):
-            edge_truth = irows_hrg >= self.m_line*icols_hrg + self.b_line*rfac
-        else:
-            edge_truth = irows_hrg <= self.m_line*icols_hrg + self.b_line*rfac
+        # Pick random locations in the light region of the high-resolution frame for the electrons.
+        elocs_hrg = np.unravel_index(get_rng().choice(self.light_idx_hrg[light_region], size=nelec), hrg_frame.shape)
 
         # Add all electrons to the event.
-        iel = 0
-        while(iel < nelec):
-        #for iel in range(nelec):
-
-            # Pick a random location in the high-resolution frame for the electron.
-            eloc_hrg = np.unravel_index(np.random.randint(hrg_frame.size),hrg_frame.shape)
-
-            # If we have specified an edge, check whether we should throw the electron.
-            if((self.m_line is not None and self.b_line is not None)):
-
-                # Do not throw the electron in the dark region.
-                irow = irows_hrg[eloc_hrg]
-                icol = icols_hrg[eloc_hrg]
-                if(((light_region == 0) and (irow < self.m_line*icol + self.b_line*rfac)) or ((light_region == 1) and (irow > self.m_line*icol + self.b_line*rfac))):
-                    continue
-
-            # Throw an electron.
-            iel += 1
+        for eloc_hrg in zip(*elocs_hrg):
 
             # Convert the location on the HRG to the original grid.
             eloc = (int(eloc_hrg[0]/rfac),int(eloc_hrg[1]/rfac))
 
             # Pick a random event from the EM dataset.
-            ievt = np.random.randint(len(self.emdset))
+            ievt = get_rng().integers(len(self.emdset))
             evt_item = self.emdset[ievt]
             evt_arr = evt_item[0]
             evt_err = evt_item[1]
 
             # Add the electron to the frame.
-            delta = int((emnet.EVT_SIZE-1)/2)  # the extent of the event from the central pixel
-            ileft = max(eloc[0]-delta,0); delta_ileft = eloc[0] - ileft
-            jleft = max(eloc[1]-delta,0); delta_jleft = eloc[1] - jleft
-
-            iright = min(eloc[0]+delta+1,frame.shape[0]); delta_iright = iright - eloc[0]
-            jright = min(eloc[1]+delta+1,frame.shape[1]); delta_jright = jright - eloc[1]
-
-            frame[ileft:iright,jleft:jright] += evt_arr[delta-delta_ileft:delta+delta_iright,delta-delta_jleft:delta+delta_jright]
+            add_event_to_frame(frame, evt_arr, eloc[0], eloc[1])
 
             # Add the electron to the truth array.
             frame_truth[eloc] = 1
@@ -634,7 +695,7 @@ class EMFrameDataset(Dataset):
 
         # Add the noise.
         if(self.noise_sigma > 0):
-            frame = gaussnoise(frame, mean=self.noise_mean, stdev=self.noise_sigma)
+            frame = gaussnoise(frame, mean=self.noise_mean, stdev=self.noise_sigma, out=self._noisy_frame)
 
         # Compute the distance matrix.
         #dist = (self.m_line*self.icols - self.irows + self.b_line) / (self.m_line**2 + 1)
@@ -656,16 +717,13 @@ class EMFrameDataset(Dataset):
         #th_truth = (frame > self.th_classical)
         #edge_frame = frame * edge_truth
 
-        # Include the edge information.
+        # Create the edge truth and distance matrix, and get the maximum argument within the edge.
         # Remove noise to reduce bias in 3x3 CM determination.
-        edge_frame = (hrg_frame - self.noise_mean/(rfac*rfac)) * edge_truth
+        edge_truth, dist, arg_max = edge_truth_dist_argmax(hrg_frame, self.noise_mean/(rfac*rfac), self.m_line, self.b_line*rfac, light_region)
 
         # ----------------------------------
         # Perform a 3*rfac x 3*rfac average.
         # ----------------------------------
-        # Get the maximum argument.
-        args_max = np.argwhere(edge_frame == np.amax(edge_frame))
-        arg_max = args_max[int(len(args_max)/2)]
         #arg_max = np.unravel_index(np.argmax(edge_frame),edge_frame.shape)
         # print("Arg max is",arg_max)
 
@@ -673,10 +731,12 @@ class EMFrameDataset(Dataset):
         llimit = int((3*rfac-1)/2)
         rlimit = int((3*rfac-1)/2 + 1)
         r_lbound = max(arg_max[0]-llimit,0)
-        r_rbound = min(arg_max[0]+rlimit,edge_frame.shape[0])
+        r_rbound = min(arg_max[0]+rlimit,hrg_frame.shape[0])
         c_lbound = max(arg_max[1]-llimit,0)
-        c_rbound = min(arg_max[1]+rlimit,edge_frame.shape[1])
-        max_3x3 = edge_frame[r_lbound:r_rbound,c_lbound:c_rbound]
+        c_rbound = min(arg_max[1]+rlimit,hrg_frame.shape[1])
+
+        # Include the edge information (only within the bounding box).
+        max_3x3 = (hrg_frame[r_lbound:r_rbound,c_lbound:c_rbound] - self.noise_mean/(rfac*rfac)) * edge_truth[r_lbound:r_rbound,c_lbound:c_rbound]
         # print("max_3x3 is",max_3x3)
         # print("llimit =",llimit," and rlimit =",rlimit)
         # print("r_lbound = ",r_lbound," and r_rbound = ",r_rbound)
@@ -698,23 +758,20 @@ class EMFrameDataset(Dataset):
         # print("weighted sum col=",np.sum(coords_pixels_3x3[0]*max_3x3),"norm=",np.sum(coords_pixels_3x3[0]*max_3x3)/np.sum(max_3x3))
 
         # Set the pixel in the truth.
-        th_truth = np.zeros(edge_frame.shape)
+        th_truth = self._th_truth; th_truth.fill(0)
         th_truth[arg_max[0] + row_offset, arg_max[1] + col_offset] = 1
         #th_truth[arg_max[0], arg_max[1]] = 1  # for normal maximum-finding
 
         # (Use the maximum)
         # th_truth[arg_max] = 1
 
-        # Compute the distance matrix.
-        dist = (self.m_line*icols_hrg - irows_hrg + self.b_line*rfac) / (self.m_line**2 + 1)
-
         # Store all the truth matrices in a single matrix.
         all_truth = []
         all_truth.append(frame_hrg_truth) #(frame_truth)
         all_truth.append(th_truth)
         all_truth.append(edge_truth)
         all_truth.append(dist)
-        all_truth = np.array(all_truth)
+        all_truth = np.array(all_truth, dtype=np.float32)
 
         return hrg_frame,all_truth
         #return frame,all_truth
@@ -824,6 +881,40 @@ def loss_reg_edge(evt_arr, evt_err, output, row_coords, col_coords, arg_max, lin
 
     return loss_vec, loss_dist, dist_reco_masked
 
+# Wraps a DataLoader (ideally with pin_memory=True), copying the next batch to the GPU on a side stream while the
+# current one is being used. The .cuda() calls in the training loops are then no-ops.
+class CUDAPrefetcher:
+    def __init__(self, loader):
+        self.loader = loader
+        self.dataset = loader.dataset
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+
+            # Wait for the copy of this batch, and let the caching allocator know it is now used on the current stream.
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream())
+
+            # Start copying the following batch before handing this one over.
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return tuple(t.cuda(non_blocking=True) for t in batch)
+
 # Regression approach with line information
 def train_regression_line(model, epoch, train_loader, optimizer, batch_size): # line_m, line_b
 
@@ -835,13 +926,12 @@ def train_regression_line(model, epoch, train_loader, optimizer, batch_size): #
     losses_epoch = []; losses_vec_epoch = []; losses_dist_epoch = []; accuracies_epoch = []
     for batch_idx, (data, arg_max, evt_err, light_region, line_m, line_b) in enumerate(train_loader):
 
-        data = data.cuda()
-        data = Variable(data)
-        arg_max = arg_max.cuda()
-        evt_err = evt_err.cuda()
-        light_region = light_region.cuda()
-        line_m = line_m.cuda()
-        line_b = line_b.cuda()
+        data = data.cuda(non_blocking=True)
+        arg_max = arg_max.cuda(non_blocking=True)
+        evt_err = evt_err.cuda(non_blocking=True)
+        light_region = light_region.cuda(non_blocking=True)
+        line_m = line_m.cuda(non_blocking=True)
+        line_b = line_b.cuda(non_blocking=True)
 
         optimizer.zero_grad()
 
@@ -896,8 +986,7 @@ def train_regression(model, epoch, train_loader, optimizer):
     losses_epoch = []; accuracies_epoch = []
     for batch_idx, (data, target) in enumerate(train_loader):
 
-        data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
+        data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
         optimizer.zero_grad()
 
         output_score = model(data)
@@ -936,10 +1025,6 @@ def loss_edge(output, target, epoch = 0, sigma_dist = 1, w_edge = 100):
     edge_truth = target[:,2,:,:]
     dist = target[:,3,:,:]
 
-    # Define some Torch functions.
-    sigmoid = torch.nn.Sigmoid()
-    bce_loss = torch.nn.BCEWithLogitsLoss(reduce=False)
-
     # Modify the truth according to the epoch.
     # frac = min(epoch/500., 1.)
     # final_target = (1-frac)*th_truth + frac*sigmoid(output)
@@ -947,14 +1032,14 @@ def loss_edge(output, target, epoch = 0, sigma_dist = 1, w_edge = 100):
     final_target = th_truth
 
     # Compute the weights (tensor of shape [batchsize]).
-    wts     = torch.sum(torch.exp(-(dist)**2/(2*sigma_dist**2))*th_truth,axis=(1,2))
-    wt_norm = torch.sum(th_truth,axis=(1,2))
-    wt_norm[wt_norm == 0] = 1
-    wts /= wt_norm
+    # wts     = torch.sum(torch.exp(-(dist)**2/(2*sigma_dist**2))*th_truth,axis=(1,2))
+    # wt_norm = torch.sum(th_truth,axis=(1,2))
+    # wt_norm[wt_norm == 0] = 1
+    # wts /= wt_norm
     #wts[wts == 0] = 0.1
 
     # Zero-out the distance on the light side.
-    dist_mod = torch.abs(dist*(edge_truth-1))
+    # dist_mod = torch.abs(dist*(edge_truth-1))
 
     # Compute the loss.
     #wts = torch.sum(torch.exp(-(dist)**2/(2*sigma_dist**2))*output,axis=0)
@@ -962,13 +1047,13 @@ def loss_edge(output, target, epoch = 0, sigma_dist = 1, w_edge = 100):
     #loss = torch.mean(torch.exp(-(dist)**2/(2*sigma_dist**2))*(bce_loss(output,final_target)))
 
     # --------------------------------------------------------------------------
-    # BCE loss.
-    loss_total = torch.sum(bce_loss(output,final_target),axis=(1,2))
+    # BCE loss (summed over the pixels of each frame and averaged over the batch).
+    loss_bce = F.binary_cross_entropy_with_logits(output,final_target,reduction='sum') / output.shape[0]
     # --------------------------------------------------------------------------
 
     # --------------------------------------------------------------------------
     # Constrained loss (tensor of shape [batchsize])
-    # loss_bce = torch.sum(bce_loss(output,final_target),axis=(1,2))
+    # loss_bce = torch.sum(F.binary_cross_entropy_with_logits(output,final_target,reduction='none'),axis=(1,2))
     # loss_sum_constraint = torch.abs(torch.sum(sigmoid(output),axis=(1,2)) - 1)
     # loss_edge_penalty = w_edge*torch.sum(sigmoid(output)*dist_mod,axis=(1,2))
     #
@@ -979,19 +1064,23 @@ def loss_edge(output, target, epoch = 0, sigma_dist = 1, w_edge = 100):
     # print("-- sum-constraint loss: {}".format(loss_sum_constraint))
     # --------------------------------------------------------------------------
 
-    # Weight the loss.
+    # Weight the loss (per-frame weights would need the per-frame loss_total, from reduction='none').
     #loss_weighted = torch.mean(wts*loss_total)
-    loss_weighted = torch.mean(loss_total)
+    loss_weighted = loss_bce
     return loss_weighted
 
 
-def train_unet(model, epoch, train_loader, optimizer, sigma_dist = 2):
+# Mixed precision: pass amp_dtype (torch.bfloat16 or torch.float16) to run the forward pass and loss under autocast,
+# and for float16 also a torch.amp.GradScaler (kept by the caller across epochs) as scaler.
+def train_unet(model, epoch, train_loader, optimizer, sigma_dist = 2, amp_dtype = None, scaler = None):
+
+    model.to(memory_format=torch.channels_last)
 
     losses_epoch = []; accuracies_epoch = []
     for batch_idx, (data, target) in enumerate(train_loader):
 
-        data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
+        data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
+        data = data.contiguous(memory_format=torch.channels_last)
 
         #print("Target is",target)
 
@@ -999,15 +1088,23 @@ def train_unet(model, epoch, train_loader, optimizer, sigma_dist = 2):
         # final_target = th_truth * edge_truth
         # final_target = final_target.unsqueeze(1)
 
-        output_score = model(data)
-        #m = nn.BCEWithLogitsLoss(weight=wts)
-        #loss = m(output_score,final_target)
-        loss = loss_edge(output_score,target,epoch,w_edge = 1.0)
+        with torch.autocast("cuda", dtype=amp_dtype, enabled=amp_dtype is not None):
+            output_score = model(data)
+            #m = nn.BCEWithLogitsLoss(weight=wts)
+            #loss = m(output_score,final_target)
+            loss = loss_edge(output_score,target,epoch,w_edge = 1.0)
 
         optimizer.zero_grad()
-        loss.backward()
-        nn.utils.clip_grad_value_(model.parameters(), 0.1)
-        optimizer.step()
+        if(scaler is not None):
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)  # clip the true (unscaled) gradients
+            nn.utils.clip_grad_value_(model.parameters(), 0.1)
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            nn.utils.clip_grad_value_(model.parameters(), 0.1)
+            optimizer.step()
 
         maxvals = (output_score[:,0,:,:] > 0.9)
         correctvals = (maxvals == target[:,0,:,:])
@@ -1027,23 +1124,32 @@ def train_unet(model, epoch, train_loader, optimizer, sigma_dist = 2):
 
     return np.mean(losses_epoch)
 
-def train(model, epoch, train_loader, optimizer):
+# (amp_dtype and scaler as for train_unet)
+def train(model, epoch, train_loader, optimizer, amp_dtype = None, scaler = None):
+
+    model.to(memory_format=torch.channels_last)
 
     losses_epoch = []; accuracies_epoch = []
     for batch_idx, (data, target) in enumerate(train_loader):
 
-        data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
+        data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
+        data = data.contiguous(memory_format=torch.channels_last)
         optimizer.zero_grad()
 
         #print("Target is",target)
 
-        output_score = model(data)
-        m = nn.CrossEntropyLoss()
-        loss = m(output_score,target)
+        with torch.autocast("cuda", dtype=amp_dtype, enabled=amp_dtype is not None):
+            output_score = model(data)
+            m = nn.CrossEntropyLoss()
+            loss = m(output_score,target)
 
-        loss.backward()
-        optimizer.step()
+        if(scaler is not None):
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         maxvals = output_score.argmax(dim=1)
         correctvals = (maxvals == target)
@@ -1068,8 +1174,7 @@ def val(model, epoch, val_loader):
     losses_epoch = []; accuracies_epoch = []
     for batch_idx, (data, target) in enumerate(val_loader):
 
-        data, target = data.cuda(), target.cuda()
-        data, target = Variable(data), Variable(target)
+        data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
 
         output_score = model(data)
         m = nn.CrossEntropyLoss()
@@ -1,4 +1,5 @@
-import numpy as np
+import math
+
 import torch
 from torch import Tensor
 
@@ -38,7 +39,7 @@ def batch_dim_to_leading_index(tensor: Tensor):
     last_dim = tensor.shape[-1]
     other_dims = tensor.shape[1:-1]
     batch_index = torch.repeat_interleave(
-        torch.arange(batch_size, device=tensor.device), np.prod(other_dims), 0
+        torch.arange(batch_size, device=tensor.device), math.prod(other_dims), 0
     )
     flattened = torch.concat([batch_index.unsqueeze(-1), tensor.view(-1, last_dim)], -1)
     return flattened.reshape(batch_size, *other_dims, last_dim + 1)
@@ -1,6 +1,5 @@
-import re
+from functools import lru_cache
 
-import numpy as np
 import spconv.pytorch as spconv
 import torch
 from torch import Tensor
@@ -27,7 +26,8 @@ def torch_sparse_to_spconv(tensor: torch.Tensor):
     if features_th.ndim == 1:
         features_th = features_th.unsqueeze(-1)
         indices_th = indices_th[:-1]
-    indices_th = indices_th.permute(1, 0).contiguous().int()
+    # transpose and cast to int32 in a single copy
+    indices_th = indices_th.T.to(torch.int32, memory_format=torch.contiguous_format)
     return spconv.SparseConvTensor(features_th, indices_th, spatial_shape, batch_size)
 
 
@@ -44,16 +44,58 @@ def spconv_to_torch_sparse(tensor: spconv.SparseConvTensor):
         return tensor
     assert isinstance(tensor, spconv.SparseConvTensor)
     size = [tensor.batch_size] + tensor.spatial_shape + [tensor.features.shape[-1]]
-    indices = tensor.indices.transpose(0, 1)
+    indices = tensor.indices.transpose(0, 1).long()
     values = tensor.features
-    return torch.sparse_coo_tensor(
+    # spconv output is usually already in sorted order, in which case the
+    # O(nnz log nnz) sort in coalesce() can be skipped
+    is_coalesced = _indices_are_coalesced(indices, torch.Size(size[:-1]))
+    out = torch.sparse_coo_tensor(
         indices,
         values,
         size,
         device=tensor.features.device,
         dtype=tensor.features.dtype,
         requires_grad=tensor.features.requires_grad,
-    ).coalesce()
+        is_coalesced=is_coalesced,
+    )
+    if not is_coalesced:
+        out = out.coalesce()
+    return out
+
+
+def _indices_are_coalesced(indices: Tensor, sparse_shape: torch.Size) -> bool:
+    """Checks whether a (sparse_dim x nnz) index tensor is lexicographically
+    sorted with no duplicates, i.e., already in coalesced order."""
+    if indices.shape[1] <= 1:
+        return True
+    dim_linear_offsets = _dim_linear_offsets(
+        sparse_shape, indices.device, indices.dtype
+    )
+    indices_linear = (indices * dim_linear_offsets.unsqueeze(-1)).sum(0)
+    return bool((indices_linear[1:] > indices_linear[:-1]).all())
+
+
+_PACKED_SPARSE_SUFFIXES = ("_indices", "_values", "_shape")
+
+
+@lru_cache
+def _packed_sparse_tensor_prefixes(keys: tuple[str, ...]) -> tuple[str, ...]:
+    """Finds the prefixes in `keys` that have all of the `_indices`, `_values`,
+    and `_shape` keys packing a sparse tensor. Cached since the batch keys are
+    the same from batch to batch.
+    """
+    key_set = set(keys)
+    prefixes = {
+        key[: -len(suffix)]
+        for key in keys
+        for suffix in _PACKED_SPARSE_SUFFIXES
+        if key.endswith(suffix) and len(key) > len(suffix)
+    }
+    return tuple(
+        prefix
+        for prefix in prefixes
+        if all(prefix + suffix in key_set for suffix in _PACKED_SPARSE_SUFFIXES)
+    )
 
 
 def unpack_sparse_tensors(batch: dict[str, Tensor]):
@@ -68,22 +110,7 @@ def unpack_sparse_tensors(batch: dict[str, Tensor]):
         dict[str, Tensor]: Input batch dict with sparse tensors unpacked into
         sparse torch.Tensor format
     """
-    prefixes_indices = [
-        match[0]
-        for match in [re.match(".+(?=_indices$)", key) for key in batch.keys()]
-        if match is not None
-    ]
-    prefixes_values = [
-        match[0]
-        for match in [re.match(".+(?=_values$)", key) for key in batch.keys()]
-        if match is not None
-    ]
-    prefixes_shape = [
-        match[0]
-        for match in [re.match(".+(?=_shape$)", key) for key in batch.keys()]
-        if match is not None
-    ]
-    prefixes = list(set(prefixes_indices) & set(prefixes_values) & set(prefixes_shape))
+    prefixes = _packed_sparse_tensor_prefixes(tuple(batch.keys()))
     for prefix in prefixes:
         shape = batch[prefix + "_shape"]
         if isinstance(shape, Tensor):
@@ -101,11 +128,26 @@ def unpack_sparse_tensors(batch: dict[str, Tensor]):
     return batch
 
 
+@lru_cache
+def _dim_linear_offsets(
+    sparse_shape: torch.Size, device: torch.device, dtype: torch.dtype
+) -> Tensor:
+    """Strides that ravel an index into a tensor of shape `sparse_shape`, i.e.,
+    the reverse cumulative product of (sparse_shape[1:] + (1,)). Cached since
+    the same shape is typically gathered from many times; the returned tensor
+    is shared and must not be modified in place.
+    """
+    shape = torch.tensor(sparse_shape[1:] + (1,), device=device, dtype=dtype)
+    return torch.flip(torch.cumprod(torch.flip(shape, [0]), 0), [0])
+
+
 def gather_from_sparse_tensor(sparse_tensor: Tensor, index_tensor: Tensor):
     """Batch selection of elements from a torch sparse tensor. Should be
-    equivalent to sparse_tensor[index_tensor]. It works by flattening the sparse
-    tensor's sparse dims and the index tensor to 1D (and converting n-d indices
-    to raveled indices), then using index_select along the flattened sparse tensor.
+    equivalent to sparse_tensor[index_tensor]. It works by converting the n-d
+    indices of both the sparse tensor and the index tensor to raveled indices,
+    then binary searching for each query in the (sorted) sparse indices and
+    reading the corresponding values directly, with zeros for queries that do
+    not match a nonzero element.
 
     Args:
         sparse_tensor (Tensor): Sparse tensor of dimension ..., M; where ... are
@@ -124,28 +166,18 @@ def gather_from_sparse_tensor(sparse_tensor: Tensor, index_tensor: Tensor):
             f"and {sparse_tensor.sparse_dim()=}"
             )
     sparse_shape = sparse_tensor.shape[: sparse_tensor.sparse_dim()]
-    dim_linear_offsets = index_tensor.new_tensor(
-        [np.prod(sparse_shape[i + 1 :] + (1,)) for i in range(len(sparse_shape))]
+    dim_linear_offsets = _dim_linear_offsets(
+        sparse_shape, index_tensor.device, index_tensor.dtype
     )
 
+    if not sparse_tensor.is_coalesced():
+        sparse_tensor = sparse_tensor.coalesce()
+    # indices of a coalesced tensor are lexicographically sorted, so their
+    # raveled versions are sorted too and can be binary searched
     sparse_tensor_indices_linear = (
         sparse_tensor.indices() * dim_linear_offsets.unsqueeze(-1)
-    ).sum(0, keepdim=True)
-    if sparse_tensor.dense_dim() > 0:
-        linear_shape = (
-            tuple(np.prod(sparse_shape, keepdims=True))
-            + sparse_tensor.shape[-sparse_tensor.dense_dim() :]
-        )
-    else:
-        linear_shape = tuple(np.prod(sparse_shape, keepdims=True))
-    sparse_tensor_linearized = torch.sparse_coo_tensor(
-        sparse_tensor_indices_linear,
-        sparse_tensor.values(),
-        linear_shape,
-        dtype=sparse_tensor.dtype,
-        device=sparse_tensor.device,
-        requires_grad=sparse_tensor.requires_grad,
-    )
+    ).sum(0)
+    sparse_tensor_values = sparse_tensor.values()
 
     if index_tensor.shape[-1] != sparse_tensor.sparse_dim():
         assert index_tensor.shape[-1] == sparse_tensor.sparse_dim() - 1
@@ -157,13 +189,21 @@ def gather_from_sparse_tensor(sparse_tensor: Tensor, index_tensor: Tensor):
         -1,
     )
 
-    selected = sparse_tensor_linearized.index_select(
-        0, index_tensor_linearized
-    ).to_dense()
-    if sparse_tensor.dense_dim() > 0:
-        selected = selected.reshape(*index_tensor_shape[:-1], selected.shape[-1])
-    else:
-        selected = selected.reshape(*index_tensor_shape[:-1])
+    dense_shape = sparse_tensor.shape[sparse_tensor.sparse_dim() :]
+    if sparse_tensor_values.shape[0] == 0:
+        return sparse_tensor_values.new_zeros(*index_tensor_shape[:-1], *dense_shape)
+
+    positions = torch.searchsorted(
+        sparse_tensor_indices_linear, index_tensor_linearized
+    ).clamp_max_(sparse_tensor_indices_linear.shape[0] - 1)
+    is_nonzero = sparse_tensor_indices_linear[positions] == index_tensor_linearized
+
+    selected = torch.where(
+        is_nonzero.view(-1, *([1] * len(dense_shape))),
+        sparse_tensor_values[positions],
+        0,
+    )
+    selected = selected.reshape(*index_tensor_shape[:-1], *dense_shape)
     return selected
 
 
@@ -175,19 +215,24 @@ def batch_offsets_from_sparse_tensor_indices(indices_tensor: Tensor):
     Args:
         indices_tensor (torch.Tensor): A tensor of shape (M x nnz), where M is
         the number of dimensions of the underlying sparse tensor and nnz is the
-        number of nonzero elements in the sparse tensor. Assumes the sparse
-        tensor has been coalesce()d.
+        number of nonzero elements in the sparse tensor. The sparse tensor
+        must have been coalesce()d, i.e., the batch indices must be sorted.
 
     Returns:
         torch.Tensor: A 1D tensor with elements corresponding the the first
         incidence of each unique element in the first position of the M axis,
-        i.e., the batch offsets if the first element is the batch index.
+        i.e., the batch offsets if the first element is the batch index. A
+        batch element with no nonzeros gets the offset of the next one.
     """
     assert not torch.is_floating_point(indices_tensor)
-    batch_indices = indices_tensor[0]
-    max_batch_index = batch_indices.max()
-    matching_indices = batch_indices.unsqueeze(-1) == torch.arange(
-        max_batch_index + 1, device=batch_indices.device, dtype=batch_indices.dtype
+    batch_indices = indices_tensor[0].contiguous()
+    # searchsorted gives wrong offsets for unsorted batch indices
+    assert (batch_indices[1:] >= batch_indices[:-1]).all()
+    batch_size = int(batch_indices[-1]) + 1
+    out = torch.searchsorted(
+        batch_indices,
+        torch.arange(
+            batch_size, device=batch_indices.device, dtype=batch_indices.dtype
+        ),
     )
-    out = matching_indices.to(torch.uint8).argmax(0)
     return out
@@ -15,5 +15,6 @@ setup(
         "pillow",
         "h5py",
         "sparse",
+        "numba",
     ],
 )
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from emsim.utils.sparse_utils import batch_offsets_from_sparse_tensor_indices
+
+
+def test_batch_offsets():
+    indices = torch.tensor([[0, 0, 1, 1, 1, 2], [3, 5, 0, 2, 4, 1]])
+    offsets = batch_offsets_from_sparse_tensor_indices(indices)
+    assert offsets.tolist() == [0, 2, 5]
+
+
+def test_batch_offsets_from_coalesced_tensor():
+    indices = torch.tensor([[1, 0, 2, 0, 1], [2, 3, 1, 5, 0]])
+    tensor = torch.sparse_coo_tensor(indices, torch.ones(5), (3, 6)).coalesce()
+    offsets = batch_offsets_from_sparse_tensor_indices(tensor.indices())
+    assert offsets.tolist() == [0, 2, 4]
+
+
+def test_batch_offsets_empty_batch_element():
+    # batch element 1 has no nonzeros, so it gets the offset of element 2
+    indices = torch.tensor([[0, 0, 2, 2], [1, 4, 0, 3]])
+    offsets = batch_offsets_from_sparse_tensor_indices(indices)
+    assert offsets.tolist() == [0, 2, 2]
+
+
+def test_batch_offsets_unsorted_indices():
+    indices = torch.tensor([[1, 0, 2, 0, 1], [2, 3, 1, 5, 0]])
+    with pytest.raises(AssertionError):
+        batch_offsets_from_sparse_tensor_indices(indices)